@@ -1,12 +1,20 @@
 import sqlite3
-import requests
+import hashlib
+import email.utils
+import httpx
 import subprocess
+import tempfile
+import threading
+import time
 import os
 import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from lxml import etree
-from datasets import Dataset
-from huggingface_hub import HfApi
-from typing import List, Dict, Optional, Tuple
+from huggingface_hub import CommitOperationAdd, HfApi
+from typing import Iterable, List, Dict, Optional, Tuple
+from pdf_text import extract_pdf_text
 
 # --- Configuration ---
 # The total number of documents to process in a single run.
@@ -21,29 +29,107 @@ LOG_FILE = "ingestion_log.log"
 API_BASE_URL = "https://gegevensmagazijn.tweedekamer.nl/SyncFeed/2.0/Feed"
 # The category of documents to fetch.
 API_CATEGORY = "Document"
+# The number of enclosures downloaded and converted concurrently per feed page.
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "12"))
+# The number of processes converting PDFs in parallel. PDFs arrive at the pace of the
+# downloads, so a few workers keep up; each one holds a PDFium instance in memory.
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(min(os.cpu_count() or 1, 4))))
 
 # --- XML Namespaces ---
 ATOM_NAMESPACE = "http://www.w3.org/2005/Atom"
 TK_NAMESPACE = "http://www.tweedekamer.nl/xsd/tkData/v1-0"
 NAMESPACES = {'atom': ATOM_NAMESPACE, 'tk': TK_NAMESPACE}
+FEED_TAG = f"{{{ATOM_NAMESPACE}}}feed"
+ENTRY_TAG = f"{{{ATOM_NAMESPACE}}}entry"
+LINK_TAG = f"{{{ATOM_NAMESPACE}}}link"
 
-# --- Logger Setup ---
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(LOG_FILE),
-        logging.StreamHandler()
-    ]
+# --- Compiled XPath Lookups ---
+ENTRY_ID_XPATH = etree.XPath("atom:id/text()", namespaces=NAMESPACES)
+CONTENT_XPATH = etree.XPath("atom:content", namespaces=NAMESPACES)
+ENCLOSURE_HREF_XPATH = etree.XPath("atom:link[@rel='enclosure']/@href", namespaces=NAMESPACES)
+
+# --- HTTP Client ---
+# Statuses that are retried, after exponential backoff or the server's Retry-After, before being returned.
+RETRY_STATUSES = {429, 502, 503, 504}
+
+class RetryTransport(httpx.HTTPTransport):
+    """HTTP transport that also retries rate-limited and temporarily unavailable responses, honouring Retry-After."""
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        for attempt in range(3):
+            response = super().handle_request(request)
+            if response.status_code not in RETRY_STATUSES:
+                return response
+            delay = max(0.5 * 2 ** attempt, self.retry_after(response))
+            response.close()
+            time.sleep(delay)
+        return super().handle_request(request)
+
+    @staticmethod
+    def retry_after(response: httpx.Response) -> float:
+        """Returns the delay in seconds requested by a Retry-After header, or 0 if there is none."""
+        value = response.headers.get("Retry-After", "").strip()
+        if not value:
+            return 0.0
+        try:
+            return float(max(int(value), 0))
+        except ValueError:
+            pass
+        try:
+            retry_at = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return 0.0
+        return max(retry_at.timestamp() - time.time(), 0.0)
+
+# A single HTTP/2 client shared by all worker threads, so concurrent feed and
+# enclosure requests are multiplexed over one TLS connection to the host.
+# httpx negotiates gzip, deflate and, with brotli installed, br by default.
+CLIENT = httpx.Client(
+    transport=RetryTransport(
+        http2=True,
+        retries=3,
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+    ),
+    headers={"User-Agent": "Tweede-Kamer-API-ingester"},
+    timeout=60,
+    follow_redirects=True,
 )
+# Only the feed requests ask for Atom; enclosure downloads accept any type.
+FEED_HEADERS = {"Accept": "application/atom+xml"}
+
+# PDFium is not thread-safe, so conversions run in a pool of worker processes, one
+# document per process at a time. Spawned rather than forked, as the parent is threaded.
+# Spawned workers re-import this script as __mp_main__, so importing it must stay cheap:
+# heavy dependencies are imported where used, and logging is set up in main().
+# The pool is started on first use and replaced when a crashed worker breaks it.
+PDF_MP_CONTEXT = multiprocessing.get_context("spawn")
+PDF_POOL: Optional[ProcessPoolExecutor] = None
+PDF_POOL_LOCK = threading.Lock()
+
+def connect_db() -> sqlite3.Connection:
+    """Opens a connection to the progress database with write-friendly pragmas."""
+    con = sqlite3.connect(DB_PATH)
+    # WAL makes each commit a sequential append; NORMAL sync is safe under WAL.
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.execute("PRAGMA temp_store=MEMORY")
+    con.execute("PRAGMA mmap_size=134217728")
+    return con
 
 def setup_database():
     """Ensures the progress tracking database and table exist."""
     try:
-        with sqlite3.connect(DB_PATH) as con:
+        with connect_db() as con:
+            # The journal mode is persistent, so setting it once here covers later connections.
+            con.execute("PRAGMA journal_mode=WAL")
             con.execute(
                 "CREATE TABLE IF NOT EXISTS progress(category TEXT PRIMARY KEY, skiptoken INTEGER)"
             )
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS seen(url TEXT PRIMARY KEY) WITHOUT ROWID"
+            )
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS seen_hashes(hash BLOB PRIMARY KEY) WITHOUT ROWID"
+            )
             logging.info(f"Database '{DB_PATH}' setup complete.")
     except sqlite3.Error as e:
         logging.error(f"Database setup failed: {e}")
@@ -52,7 +138,7 @@ def setup_database():
 def get_skiptoken(category: str) -> int:
     """Retrieves the last saved skiptoken for a given category."""
     try:
-        with sqlite3.connect(DB_PATH) as con:
+        with connect_db() as con:
             cur = con.execute("SELECT skiptoken FROM progress WHERE category=?", (category,))
             row = cur.fetchone()
             if row:
@@ -65,22 +151,94 @@ def get_skiptoken(category: str) -> int:
         logging.error(f"Failed to get skiptoken: {e}")
         return -1
 
-def save_skiptoken(category: str, skiptoken: int) -> None:
-    """Saves the latest skiptoken for a category to the database."""
+def save_skiptoken(
+    category: str,
+    skiptoken: Optional[int],
+    ingested_urls: Iterable[str] = (),
+    content_digests: Iterable[bytes] = (),
+) -> None:
+    """Saves the latest skiptoken for a category, and any newly ingested URLs and content hashes, in one transaction."""
     try:
-        with sqlite3.connect(DB_PATH) as con:
-            con.execute("REPLACE INTO progress(category, skiptoken) VALUES(?,?)", (category, skiptoken))
+        with connect_db() as con:
+            if skiptoken is not None:
+                con.execute("REPLACE INTO progress(category, skiptoken) VALUES(?,?)", (category, skiptoken))
+            con.executemany("INSERT OR IGNORE INTO seen(url) VALUES(?)", ((url,) for url in ingested_urls))
+            con.executemany("INSERT OR IGNORE INTO seen_hashes(hash) VALUES(?)", ((digest,) for digest in content_digests))
             con.commit()
-            logging.info(f"Saved skiptoken: {skiptoken} for category '{category}'.")
+            if skiptoken is not None:
+                logging.info(f"Saved skiptoken: {skiptoken} for category '{category}'.")
     except sqlite3.Error as e:
         logging.error(f"Failed to save skiptoken {skiptoken}: {e}")
 
-def convert_pdf_to_text(pdf_content: bytes) -> str:
-    """Converts PDF content from bytes to plain text using the 'pdftotext' utility."""
+def is_url_ingested(con: sqlite3.Connection, url: str) -> bool:
+    """Checks whether an enclosure URL was already pushed in an earlier batch."""
+    return con.execute("SELECT 1 FROM seen WHERE url=?", (url,)).fetchone() is not None
+
+def content_digest(content: str) -> bytes:
+    """Returns the SHA-256 fingerprint used to detect duplicate document content."""
+    return hashlib.sha256(content.encode('utf-8'), usedforsecurity=False).digest()
+
+def drop_duplicate_content(docs: List[Dict[str, str]], run_digests: set) -> Tuple[List[Dict[str, str]], List[str]]:
+    """
+    Drops documents whose content was already ingested in an earlier run or earlier in this one.
+    Returns the remaining documents and the URLs of the dropped ones.
+    """
+    unique_docs = []
+    duplicate_urls = []
+    try:
+        with connect_db() as con:
+            for doc in docs:
+                digest = content_digest(doc["content"])
+                if digest in run_digests or con.execute("SELECT 1 FROM seen_hashes WHERE hash=?", (digest,)).fetchone():
+                    logging.info(f"Skipping {doc['URL']}: duplicate content.")
+                    duplicate_urls.append(doc["URL"])
+                    continue
+                run_digests.add(digest)
+                unique_docs.append(doc)
+    except sqlite3.Error as e:
+        logging.error(f"Failed to check content hashes: {e}")
+        return docs, []
+    return unique_docs, duplicate_urls
+
+def get_pdf_pool(broken_pool: Optional[ProcessPoolExecutor] = None) -> ProcessPoolExecutor:
+    """
+    Returns the shared PDF process pool, starting it if needed. Passing the pool a task failed on
+    replaces it if it is still the current one, so concurrent callers restart a broken pool only once.
+    """
+    global PDF_POOL
+    with PDF_POOL_LOCK:
+        if PDF_POOL is None or PDF_POOL is broken_pool:
+            if PDF_POOL is not None:
+                PDF_POOL.shutdown(wait=False)
+            PDF_POOL = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=PDF_MP_CONTEXT)
+        return PDF_POOL
+
+def extract_pdf_text_isolated(pdf_path: str) -> str:
+    """Runs a single PDFium conversion in a worker process of its own."""
+    with ProcessPoolExecutor(max_workers=1, mp_context=PDF_MP_CONTEXT) as pool:
+        return pool.submit(extract_pdf_text, pdf_path).result()
+
+def convert_pdf_to_text(pdf_path: str) -> str:
+    """
+    Converts a PDF file to plain text with PDFium in the shared process pool, avoiding a
+    process spawn per document. Falls back to the 'pdftotext' utility for PDFs that PDFium cannot open.
+    """
+    pool = get_pdf_pool()
+    try:
+        try:
+            return pool.submit(extract_pdf_text, pdf_path).result()
+        except BrokenProcessPool:
+            # A worker died, on this PDF or another one in flight. Restart the shared pool for later
+            # documents and retry this one alone, so a PDF that crashes PDFium again takes down no others.
+            logging.warning(f"A PDFium worker crashed while converting '{pdf_path}', restarting the PDF pool and retrying it.")
+            get_pdf_pool(broken_pool=pool)
+            return extract_pdf_text_isolated(pdf_path)
+    except Exception as e:
+        logging.warning(f"PDFium could not convert '{pdf_path}', falling back to pdftotext: {e}")
+
     try:
         process = subprocess.run(
-            ["pdftotext", "-q", "-", "-"],
-            input=pdf_content,
+            ["pdftotext", "-q", pdf_path, "-"],
             capture_output=True,
             check=True,
         )
@@ -96,15 +254,13 @@ def convert_pdf_to_text(pdf_content: bytes) -> str:
         logging.error(f"An unexpected error occurred during PDF conversion: {e}")
         return ""
 
-def fetch_and_process_entry(entry: etree._Element) -> Optional[Dict[str, str]]:
-    """
-    Parses a single <entry> element, downloads its content, and returns a structured dict.
-    This function also handles scraping of XML/HTML content by returning it as plain text.
-    """
-    entry_id = entry.find("atom:id", NAMESPACES).text if entry.find("atom:id", NAMESPACES) is not None else "N/A"
+def get_enclosure_url(entry: etree._Element) -> Optional[str]:
+    """Parses a single <entry> element and returns its enclosure URL, or None if it should be skipped."""
+    entry_id = (ENTRY_ID_XPATH(entry) or ["N/A"])[0]
     
     # Check if the entry is marked as deleted
-    content_element = entry.find("atom:content", NAMESPACES)
+    content_elements = CONTENT_XPATH(entry)
+    content_element = content_elements[0] if content_elements else None
     if content_element is not None and content_element.text:
         try:
             nested_xml = etree.fromstring(content_element.text.encode('utf-8'))
@@ -115,39 +271,51 @@ def fetch_and_process_entry(entry: etree._Element) -> Optional[Dict[str, str]]:
             pass # Not all content is XML
 
     # Find the enclosure link which contains the actual document
-    enclosure_link = entry.find("atom:link[@rel='enclosure']", NAMESPACES)
-    if enclosure_link is None or not enclosure_link.get("href"):
+    enclosure_hrefs = ENCLOSURE_HREF_XPATH(entry)
+    if not enclosure_hrefs or not enclosure_hrefs[0]:
         logging.warning(f"Skipping entry {entry_id}: no enclosure URL found.")
         return None
     
-    enclosure_url = enclosure_link.get("href")
-    
+    return enclosure_hrefs[0]
+
+def fetch_and_process_enclosure(enclosure_url: str) -> Optional[Dict[str, str]]:
+    """
+    Downloads the content behind an enclosure URL and returns a structured dict.
+    This function also handles scraping of XML/HTML content by returning it as plain text.
+    """
     try:
-        # Download the document content
-        dresp = requests.get(enclosure_url, timeout=60)
-        dresp.raise_for_status()
-        content_type = dresp.headers.get('Content-Type', '').split(';')[0].strip().lower()
-        
-        fetched_content = ""
-        if content_type == "application/pdf":
-            logging.info(f"Converting PDF: {enclosure_url}")
-            fetched_content = convert_pdf_to_text(dresp.content)
-        elif content_type.startswith("text/") or content_type == "application/xml":
-            logging.info(f"Scraping text/xml content from: {enclosure_url}")
-            # For text or XML, we just use the text content directly.
-            # This effectively "scrapes" the content from these files.
-            fetched_content = dresp.text
-        else:
-            logging.warning(f"Skipping unsupported content type '{content_type}' for URL: {enclosure_url}")
-            return None
-            
+        # Stream the document content so large PDFs are not buffered in memory
+        with CLIENT.stream("GET", enclosure_url) as dresp:
+            dresp.raise_for_status()
+            content_type = dresp.headers.get('Content-Type', '').split(';')[0].strip().lower()
+
+            fetched_content = ""
+            if content_type == "application/pdf":
+                logging.info(f"Converting PDF: {enclosure_url}")
+                # Spool the PDF to disk in chunks; PDFium reads it from the file
+                # rather than from a full in-memory copy.
+                with tempfile.NamedTemporaryFile(suffix=".pdf") as pdf_file:
+                    for chunk in dresp.iter_bytes(chunk_size=65536):
+                        pdf_file.write(chunk)
+                    pdf_file.flush()
+                    fetched_content = convert_pdf_to_text(pdf_file.name)
+            elif content_type.startswith("text/") or content_type == "application/xml":
+                logging.info(f"Scraping text/xml content from: {enclosure_url}")
+                # For text or XML, we just use the text content directly.
+                # This effectively "scrapes" the content from these files.
+                dresp.read()
+                fetched_content = dresp.text
+            else:
+                logging.warning(f"Skipping unsupported content type '{content_type}' for URL: {enclosure_url}")
+                return None
+
         if not fetched_content.strip():
             logging.warning(f"Content from {enclosure_url} is empty after processing. Skipping.")
             return None
             
         return {"URL": enclosure_url, "content": fetched_content, "Source": "Tweede Kamer"}
 
-    except requests.exceptions.RequestException as e:
+    except (httpx.HTTPError, httpx.InvalidURL) as e:
         logging.error(f"Error fetching enclosure '{enclosure_url}': {e}")
         return None
 
@@ -158,40 +326,59 @@ def fetch_api_page(category: str, skiptoken: Optional[int]) -> Tuple[List[Dict[s
         params["skiptoken"] = skiptoken
     
     logging.info(f"Fetching API with params: {params}")
+    # Parse the feed incrementally as it is received, dispatching each entry's download
+    # as soon as it is parsed and freeing it, so only one entry is held in memory.
+    futures = []
+    entry_count = 0
+    next_href = None
+    parser = etree.XMLPullParser(events=("end",), tag=(ENTRY_TAG, LINK_TAG))
     try:
-        resp = requests.get(API_BASE_URL, params=params, timeout=60)
-        resp.raise_for_status()
-    except requests.exceptions.RequestException as e:
+        with connect_db() as con, \
+                CLIENT.stream("GET", API_BASE_URL, params=params, headers=FEED_HEADERS) as resp, \
+                ThreadPoolExecutor(max_workers=INGEST_WORKERS) as executor:
+            resp.raise_for_status()
+            content_encoding = resp.headers.get("Content-Encoding", "identity")
+            for chunk in resp.iter_bytes():
+                parser.feed(chunk)
+                for _, elem in parser.read_events():
+                    if elem.tag == LINK_TAG:
+                        if elem.getparent().tag == FEED_TAG and elem.get("rel") == "next":
+                            next_href = elem.get("href")
+                        continue
+                    entry_count += 1
+                    enclosure_url = get_enclosure_url(elem)
+                    if enclosure_url and is_url_ingested(con, enclosure_url):
+                        logging.info(f"Skipping {enclosure_url}: already ingested.")
+                    elif enclosure_url:
+                        futures.append(executor.submit(fetch_and_process_enclosure, enclosure_url))
+                    elem.clear()
+                    while elem.getprevious() is not None:
+                        del elem.getparent()[0]
+            parser.close()
+    except (httpx.HTTPError, etree.XMLSyntaxError, sqlite3.Error) as e:
         logging.error(f"Failed to fetch API feed: {e}")
         return [], None
 
-    root = etree.fromstring(resp.content)
-    entries = root.findall("atom:entry", NAMESPACES)
-    logging.info(f"API returned {len(entries)} entries.")
-    
-    processed_docs = []
-    for entry in entries:
-        doc = fetch_and_process_entry(entry)
-        if doc:
-            processed_docs.append(doc)
+    logging.info(f"API returned {entry_count} entries (Content-Encoding: {content_encoding}).")
+    # Futures were submitted in feed order, so the documents keep that order.
+    processed_docs = [doc for doc in (f.result() for f in futures) if doc]
 
     # Find the skiptoken for the next page
-    next_link = root.find("atom:link[@rel='next']", NAMESPACES)
     next_skiptoken = None
-    if next_link is not None and "skiptoken=" in next_link.get("href", ""):
+    if next_href and "skiptoken=" in next_href:
         try:
-            token_str = next_link.get("href").split("skiptoken=")[1].split("&")[0]
+            token_str = next_href.split("skiptoken=")[1].split("&")[0]
             next_skiptoken = int(token_str)
         except (ValueError, IndexError):
             logging.warning("Could not parse skiptoken from 'next' link.")
             
     return processed_docs, next_skiptoken
 
-def push_batch_to_hf(docs: List[Dict[str, str]], repo_id: str, batch_number: int):
-    """Pushes a list of documents as a Parquet file to a Hugging Face dataset repo."""
+def push_batch_to_hf(docs: List[Dict[str, str]], repo_id: str, batch_number: int) -> bool:
+    """Pushes a list of documents as a Parquet file to a Hugging Face dataset repo. Returns True on success."""
     if not docs:
         logging.info("No documents in the current batch to push.")
-        return
+        return True
         
     logging.info(f"--- Preparing to push batch #{batch_number} with {len(docs)} documents to {repo_id} ---")
     api = HfApi()
@@ -199,30 +386,74 @@ def push_batch_to_hf(docs: List[Dict[str, str]], repo_id: str, batch_number: int
     repo_file_path = f"data/batch_{batch_number}.parquet"
     
     try:
+        # Imported here rather than at the top, as datasets is heavy and PDF workers re-import this script
+        from datasets import Dataset
+
         # Create a Dataset object and save to a local Parquet file
         ds = Dataset.from_list(docs)
-        ds.to_parquet(local_parquet_path)
+        ds.to_parquet(local_parquet_path, compression="zstd")
         logging.info(f"Successfully saved batch to '{local_parquet_path}'.")
 
         # Upload the file to the Hugging Face Hub
-        api.upload_file(
-            path_or_fileobj=local_parquet_path,
-            path_in_repo=repo_file_path,
+        api.create_commit(
             repo_id=repo_id,
             repo_type="dataset",
+            operations=[CommitOperationAdd(path_in_repo=repo_file_path, path_or_fileobj=local_parquet_path)],
+            commit_message=f"batch {batch_number}",
         )
         logging.info(f"Successfully uploaded batch #{batch_number} to repository.")
+        return True
         
     except Exception as e:
         logging.error(f"Failed to upload batch to Hugging Face: {e}")
+        return False
     finally:
         # Clean up the local file after upload
         if os.path.exists(local_parquet_path):
             os.remove(local_parquet_path)
             logging.info(f"Cleaned up local file: {local_parquet_path}")
 
+def push_batch_and_save_progress(
+    docs: List[Dict[str, str]],
+    duplicate_urls: List[str],
+    repo_id: str,
+    batch_number: int,
+    skiptoken: Optional[int],
+    upload_failed: threading.Event,
+) -> bool:
+    """
+    Pushes a batch and, only if the push succeeded, saves the skiptoken, URLs and content hashes that it covers.
+    The URLs of duplicates dropped from the batch's pages are marked as seen too, so they are not downloaded again.
+    Once any batch fails, later batches no longer advance the skiptoken, so the failed batch's pages are fetched again next run.
+    """
+    if not push_batch_to_hf(docs, repo_id, batch_number):
+        upload_failed.set()
+        return False
+    if upload_failed.is_set():
+        logging.warning(f"Not saving skiptoken {skiptoken}: an earlier batch failed to upload.")
+        skiptoken = None
+    save_skiptoken(
+        API_CATEGORY,
+        skiptoken,
+        [doc["URL"] for doc in docs] + duplicate_urls,
+        [content_digest(doc["content"]) for doc in docs],
+    )
+    return True
+
 def main():
     """Main function to run the ingestion and upload process."""
+    # --- Logger Setup ---
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler(LOG_FILE),
+            logging.StreamHandler()
+        ]
+    )
+    # httpx logs every request at INFO; keep the log focused on ingestion progress.
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
     logging.info("--- Starting ingestion process ---")
     
     # Ensure HF_REPO_ID is set, e.g., "vGassen/Dutch-Tweede-Kamer-API"
@@ -236,51 +467,71 @@ def main():
     total_docs_collected = 0
     batch_number = 1
     docs_for_current_batch = []
+    # URLs of duplicate documents dropped from the pages of the current batch
+    duplicates_for_current_batch = []
+    # Content hashes of documents collected this run, including batches not yet pushed
+    run_digests = set()
     
     # Get the starting skiptoken from the last run
     current_skiptoken = get_skiptoken(API_CATEGORY)
 
-    while total_docs_collected < TOTAL_DOCUMENT_LIMIT:
-        remaining_limit = TOTAL_DOCUMENT_LIMIT - total_docs_collected
+    # A single upload worker keeps pushes, and therefore skiptoken saves, in batch order.
+    upload_failed = threading.Event()
+    pending_uploads = []
+    with ThreadPoolExecutor(max_workers=1) as upload_pool:
+        while total_docs_collected < TOTAL_DOCUMENT_LIMIT:
+            remaining_limit = TOTAL_DOCUMENT_LIMIT - total_docs_collected
         
-        # Fetch a page of data from the API
-        new_docs, next_skiptoken = fetch_api_page(API_CATEGORY, current_skiptoken)
+            # Fetch a page of data from the API
+            new_docs, next_skiptoken = fetch_api_page(API_CATEGORY, current_skiptoken)
         
-        if not new_docs and next_skiptoken is None:
-            logging.info("No more documents available from the feed. Ending process.")
-            break
+            if not new_docs and next_skiptoken is None:
+                logging.info("No more documents available from the feed. Ending process.")
+                break
         
-        # Add new documents to the batch, respecting the total limit
-        docs_to_add = new_docs[:remaining_limit]
-        docs_for_current_batch.extend(docs_to_add)
-        total_docs_collected += len(docs_to_add)
+            # Add new documents to the batch, respecting the total limit
+            new_docs, duplicate_urls = drop_duplicate_content(new_docs, run_digests)
+            duplicates_for_current_batch.extend(duplicate_urls)
+            docs_to_add = new_docs[:remaining_limit]
+            docs_for_current_batch.extend(docs_to_add)
+            total_docs_collected += len(docs_to_add)
         
-        logging.info(f"Collected {len(docs_to_add)} new documents. Total collected: {total_docs_collected}/{TOTAL_DOCUMENT_LIMIT}")
-
-        # If batch is full, upload it
-        if len(docs_for_current_batch) >= UPLOAD_BATCH_SIZE:
-            push_batch_to_hf(docs_for_current_batch, hf_repo_id, batch_number)
-            # Save progress *after* a successful push
-            if current_skiptoken is not None:
-                save_skiptoken(API_CATEGORY, current_skiptoken)
-            batch_number += 1
-            docs_for_current_batch = [] # Reset for the next batch
-        
-        # Update skiptoken and check for end of feed
-        current_skiptoken = next_skiptoken
-        if current_skiptoken is None:
-            logging.info("Reached the end of the API feed.")
-            break
-
-    # Push any remaining documents in the last batch
-    if docs_for_current_batch:
-        logging.info("Pushing the final batch of documents.")
-        push_batch_to_hf(docs_for_current_batch, hf_repo_id, batch_number)
-    
-    # Save the final skiptoken
-    if current_skiptoken is not None:
-        save_skiptoken(API_CATEGORY, current_skiptoken)
+            logging.info(f"Collected {len(docs_to_add)} new documents. Total collected: {total_docs_collected}/{TOTAL_DOCUMENT_LIMIT}")
+
+            # If batch is full, upload it
+            if len(docs_for_current_batch) >= UPLOAD_BATCH_SIZE:
+                # Upload in the background while the next page is crawled;
+                # progress is saved *after* a successful push
+                pending_uploads.append(upload_pool.submit(
+                    push_batch_and_save_progress,
+                    docs_for_current_batch, duplicates_for_current_batch, hf_repo_id, batch_number, current_skiptoken, upload_failed,
+                ))
+                batch_number += 1
+                docs_for_current_batch = [] # Reset for the next batch
+                duplicates_for_current_batch = []
         
+            # Update skiptoken and check for end of feed
+            current_skiptoken = next_skiptoken
+            if current_skiptoken is None:
+                logging.info("Reached the end of the API feed.")
+                break
+
+        # Push any remaining documents in the last batch and save the final skiptoken
+        # (an empty final batch only saves the skiptoken and dropped duplicates, and only if no earlier push failed)
+        if docs_for_current_batch or duplicates_for_current_batch or current_skiptoken is not None:
+            if docs_for_current_batch:
+                logging.info("Pushing the final batch of documents.")
+            pending_uploads.append(upload_pool.submit(
+                push_batch_and_save_progress,
+                docs_for_current_batch, duplicates_for_current_batch, hf_repo_id, batch_number, current_skiptoken, upload_failed,
+            ))
+
+    for future in pending_uploads:
+        future.result()
+    if upload_failed.is_set():
+        logging.error("One or more batches failed to upload; progress was not saved past the first failed batch.")
+    if PDF_POOL is not None:
+        PDF_POOL.shutdown()
     logging.info(f"--- Ingestion process finished. Collected a total of {total_docs_collected} documents. ---")
 
 if __name__ == "__main__":
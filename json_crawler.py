@@ -1,140 +1,348 @@
 import os
+import re
+import hashlib
+import email.utils
 import sys
 import json
 import time
 import logging
-import requests
-from typing import List, Dict, Optional
+import httpx
+import orjson
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from selectolax.lexbor import LexborHTMLParser
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Dict, Optional, Tuple
 from pathlib import Path
-from huggingface_hub import HfApi, HfFolder
+from huggingface_hub import CommitOperationAdd, HfApi, HfFolder
 
 # ========== Configuration ==========
-BATCH_SIZE         = int(os.getenv("BATCH_SIZE", "100"))
+BATCH_SIZE         = int(os.getenv("BATCH_SIZE", "250")) # OData server page size limit
 ODATA_URL          = os.getenv("ODATA_URL", "https://gegevensmagazijn.tweedekamer.nl/OData/v4/2.0/Document")
 ODATA_PARAMS       = json.loads(os.getenv("ODATA_PARAMS", '{"$filter": "Verwijderd eq false"}'))
 STATE_PATH         = os.getenv("STATE_PATH", "tk_state.json")
-OUTPUT_PATH        = os.getenv("OUTPUT_PATH", "tk_crawl.jsonl")
+CHECKPOINT_PATH    = os.getenv("CHECKPOINT_PATH", "tk_shard_{start}.arrows") # records of the shard not yet uploaded
 HF_REPO_ID         = os.getenv("HF_REPO_ID", "vGassen/Dutch-Tweede-Kamer-API")
 SOURCE_LABEL       = os.getenv("SOURCE_LABEL", "Tweede Kamer")
 SHARD_SIZE         = int(os.getenv("SHARD_SIZE", "300")) # ~25 MiB limit
+SHARD_MAX_BYTES    = int(os.getenv("SHARD_MAX_BYTES", str(25 * 1024 * 1024)))
 MAX_ENTRIES        = int(os.getenv("MAX_ENTRIES", "10000"))
+FETCH_WORKERS      = int(os.getenv("FETCH_WORKERS", "8"))
 HF_TOKEN           = os.getenv("HF_TOKEN") or HfFolder.get_token()
 
+RECORD_SCHEMA = pa.schema([
+    ("URL", pa.string()),
+    ("Content", pa.large_string()),
+    ("Source", pa.string()),
+])
+
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 
+# ========== Text Cleaning Patterns ==========
+_WS_RE = re.compile(r"\s+")
+
+# ========== HTTP Client ==========
+# Statuses that are retried, after exponential backoff or the server's Retry-After, before being returned.
+RETRY_STATUSES = {429, 502, 503, 504}
+
+class RetryTransport(httpx.HTTPTransport):
+    """HTTP transport that also retries rate-limited and temporarily unavailable responses, honouring Retry-After."""
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        for attempt in range(3):
+            response = super().handle_request(request)
+            if response.status_code not in RETRY_STATUSES:
+                return response
+            delay = max(0.5 * 2 ** attempt, self.retry_after(response))
+            response.close()
+            time.sleep(delay)
+        return super().handle_request(request)
+
+    @staticmethod
+    def retry_after(response: httpx.Response) -> float:
+        """Returns the delay in seconds requested by a Retry-After header, or 0 if there is none."""
+        value = response.headers.get("Retry-After", "").strip()
+        if not value:
+            return 0.0
+        try:
+            return float(max(int(value), 0))
+        except ValueError:
+            pass
+        try:
+            retry_at = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return 0.0
+        return max(retry_at.timestamp() - time.time(), 0.0)
+
+# One HTTP/2 client shared by the page fetch workers; httpx negotiates br when brotli is installed
+CLIENT = httpx.Client(
+    transport=RetryTransport(
+        http2=True,
+        retries=3,
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+    ),
+    headers={
+        "Accept": "application/json",
+        "Prefer": f"odata.maxpagesize={BATCH_SIZE}",
+        "User-Agent": "Tweede-Kamer-API-ingester",
+    },
+    timeout=60,
+    follow_redirects=True,
+)
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
 # ========== State Management ==========
 def load_state(path: str) -> dict:
     if os.path.exists(path):
         with open(path, "r", encoding="utf-8") as f:
             return json.load(f)
-    return {"skip": 0}
+    return {"skip": 0, "checkpoint_bytes": 0}
 
 def save_state(path: str, state: dict):
-    with open(path, "w", encoding="utf-8") as f:
+    # Write to a temporary file and rename it over the old state, so a crash never leaves it half-written
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
         json.dump(state, f)
+    os.replace(tmp_path, path)
 
 # ========== Main Crawler ==========
 def fetch_documents(skip: int, top: int) -> List[Dict]:
     params = ODATA_PARAMS.copy()
     params["$top"] = top
     params["$skip"] = skip
-    resp = requests.get(ODATA_URL, params=params, timeout=60)
+    resp = CLIENT.get(ODATA_URL, params=params)
     resp.raise_for_status()
-    data = resp.json()
+    data = orjson.loads(resp.content)
     return data.get("value", [])
 
+def count_documents() -> Optional[int]:
+    params = ODATA_PARAMS.copy()
+    params["$count"] = "true"
+    params["$top"] = 0
+    try:
+        resp = CLIENT.get(ODATA_URL, params=params)
+        resp.raise_for_status()
+        return orjson.loads(resp.content)["@odata.count"]
+    except Exception as e:
+        logging.warning(f"Could not count documents, falling back to serial paging: {e}")
+        return None
+
+def fetch_page(skip: int) -> Optional[List[Dict]]:
+    logging.info(f"Fetching documents with $skip={skip}, $top={BATCH_SIZE}")
+    for attempt in range(3):
+        try:
+            return fetch_documents(skip, BATCH_SIZE)
+        except Exception as e:
+            logging.warning(f"Fetch failed at $skip={skip} (try {attempt+1}/3): {e}")
+            time.sleep(3)
+    return None
+
+def iter_pages(start: int, end: int, workers: int) -> Iterator[Optional[List[Dict]]]:
+    # Fetch disjoint $skip windows of `workers` pages concurrently; map() yields them in order
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for window_start in range(start, end, workers * BATCH_SIZE):
+            skips = range(window_start, min(window_start + workers * BATCH_SIZE, end), BATCH_SIZE)
+            yield from executor.map(fetch_page, skips)
+
 def clean_text(text):
-    import re
     if not text:
         return ""
-    text = re.sub(r"<(script|style).*?>.*?</\1>", "", text, flags=re.DOTALL)
-    text = re.sub(r"<[^>]+>", "", text)
-    text = re.sub(r"\s+", " ", text)
-    return text.strip()
-
-def emit_jsonl(docs: List[Dict], path: str, label: str):
-    with open(path, "a", encoding="utf-8") as f:
-        for doc in docs:
-            url = doc.get("ResourceUrl") or doc.get("Id") or doc.get("DocumentId") or doc.get("url") or doc.get("@odata.id")
-            text = doc.get("Tekst") or doc.get("BodyText") or doc.get("Body") or doc.get("Omschrijving") or doc.get("Titel") or ""
-            content = clean_text(text)
-            record = {
-                "URL": str(url),
-                "Content": content,
-                "Source": label,
-            }
-            f.write(json.dumps(record, ensure_ascii=False) + "\n")
-
-def push_to_hf(jsonl_path: str, repo_id: str, hf_token: str):
-    api = HfApi()
-    # Get existing files in the Hugging Face repo (for true incremental upload)
-    try:
-        repo_files = set(api.list_repo_files(repo_id=repo_id, repo_type="dataset", token=hf_token))
-    except Exception as e:
-        logging.warning(f"Could not list remote files: {e}")
-        repo_files = set()
+    tree = LexborHTMLParser(text)
+    for tag in tree.css("script, style"):
+        tag.decompose()
+    body_text = tree.body.text(separator=" ") if tree.body else ""
+    return _WS_RE.sub(" ", body_text).strip()
 
-    if not os.path.exists(jsonl_path):
-        logging.warning("No output file found.")
+def checkpoint_path(shard_start: int) -> str:
+    return CHECKPOINT_PATH.format(start=shard_start)
+
+def write_checkpoint(path: str, data, mode: str):
+    # The IPC writer issues several small writes per batch, so buffer them into a single write
+    with pa.OSFile(path, mode) as output_file, \
+            pa.BufferedOutputStream(output_file, buffer_size=8 * 1024 * 1024) as sink, \
+            pa.ipc.new_stream(sink, RECORD_SCHEMA) as writer:
+        writer.write(data)
+
+def emit_records(docs: List[Dict], path: str, label: str, seen_digests: set) -> Tuple[int, int]:
+    # Build the batch column-wise rather than as per-record dicts
+    urls = []
+    contents = []
+    for doc in docs:
+        url = doc.get("ResourceUrl") or doc.get("Id") or doc.get("DocumentId") or doc.get("url") or doc.get("@odata.id")
+        text = doc.get("Tekst") or doc.get("BodyText") or doc.get("Body") or doc.get("Omschrijving") or doc.get("Titel") or ""
+        content = clean_text(text)
+        if content:
+            # Skip documents whose cleaned content was already emitted this run
+            digest = hashlib.sha256(content.encode("utf-8"), usedforsecurity=False).digest()
+            if digest in seen_digests:
+                logging.info(f"Skipping {url}: duplicate content.")
+                continue
+            seen_digests.add(digest)
+        urls.append(str(url))
+        contents.append(content)
+    content_array = pa.array(contents, type=pa.large_string())
+    batch = pa.RecordBatch.from_arrays(
+        [
+            pa.array(urls, type=pa.string()),
+            content_array,
+            pa.array([label] * len(urls), type=pa.string()),
+        ],
+        schema=RECORD_SCHEMA,
+    )
+    # Append the page to the checkpoint as its own IPC stream
+    write_checkpoint(path, batch, "ab")
+    return batch.num_rows, pc.sum(pc.binary_length(content_array)).as_py() or 0
+
+def iter_record_batches(arrow_path: str):
+    # Every emitted page is its own IPC stream, so read them back to back.
+    size = os.path.getsize(arrow_path)
+    with pa.OSFile(arrow_path) as source:
+        while source.tell() < size:
+            yield from pa.ipc.open_stream(source)
+
+def complete_streams_end(path: str) -> int:
+    # Offset just past the last IPC stream in the checkpoint that can be read in full
+    end = 0
+    with pa.OSFile(path) as source:
+        size = source.size()
+        try:
+            while source.tell() < size:
+                for _ in pa.ipc.open_stream(source):
+                    pass
+                end = source.tell()
+        except (pa.ArrowInvalid, OSError):
+            pass
+    return end
+
+def recover_checkpoint(path: str, recorded_bytes: Optional[int]):
+    # Cut the checkpoint back to what the state file covers. Anything past `recorded_bytes` is a page
+    # appended, or torn, by a run that crashed before advancing $skip, and will be fetched again.
+    if not os.path.exists(path):
         return
+    size = os.path.getsize(path)
+    if recorded_bytes is None or size < recorded_bytes:
+        # No usable record (an older state file, or the checkpoint lost data): keep the complete streams
+        if recorded_bytes is not None:
+            logging.error(f"Checkpoint {path} is shorter than recorded ({size} < {recorded_bytes} bytes).")
+        recorded_bytes = complete_streams_end(path)
+    if size > recorded_bytes:
+        logging.warning(f"Dropping {size - recorded_bytes} unrecorded bytes from checkpoint {path}.")
+        os.truncate(path, recorded_bytes)
+
+def read_checkpoint(path: str) -> pa.Table:
+    if not os.path.exists(path):
+        return RECORD_SCHEMA.empty_table()
+    return pa.Table.from_batches(list(iter_record_batches(path)), schema=RECORD_SCHEMA)
+
+def checkpoint_stats(path: str) -> Tuple[int, int]:
+    table = read_checkpoint(path)
+    return table.num_rows, pc.sum(pc.binary_length(table["Content"])).as_py() or 0
+
+def shard_length(sizes: List[int], offset: int) -> int:
+    # Number of rows from `offset` that fit in one shard by record count and content size
+    length = 0
+    shard_bytes = 0
+    for size in sizes[offset:offset + SHARD_SIZE]:
+        if length and shard_bytes + size > SHARD_MAX_BYTES:
+            break
+        length += 1
+        shard_bytes += size
+    return length
+
+def parquet_bytes(table: pa.Table) -> bytes:
+    sink = pa.BufferOutputStream()
+    pq.write_table(table, sink, compression="zstd", compression_level=6, row_group_size=1000)
+    return sink.getvalue().to_pybytes()
+
+def push_shards(api: HfApi, shard_start: int, skip: int, final: bool) -> int:
+    # Upload every full shard held in the checkpoint, plus the incomplete tail when `final`,
+    # in a single commit. Returns the record offset at which the next shard starts.
+    path = checkpoint_path(shard_start)
+    table = read_checkpoint(path)
+    sizes = pc.binary_length(table["Content"]).to_pylist()
+    operations = []
+    offset = 0
+    while offset < table.num_rows:
+        length = shard_length(sizes, offset)
+        if not final and length < SHARD_SIZE and offset + length == table.num_rows:
+            break
+        start = shard_start + offset
+        operations.append(CommitOperationAdd(
+            path_in_repo=f"shards/shard_{start}_{start + length}.parquet",
+            path_or_fileobj=parquet_bytes(table.slice(offset, length)),
+        ))
+        offset += length
+    if not operations:
+        return shard_start
 
-    with open(jsonl_path, "r", encoding="utf-8") as f:
-        lines = f.readlines()
-    n = 0
-    for i in range(0, len(lines), SHARD_SIZE):
-        shard_lines = lines[i:i + SHARD_SIZE]
-        shard_path = f"shard_{i}_{i+len(shard_lines)}.jsonl"
-        hf_dest = f"shards/{shard_path}"
-        if hf_dest in repo_files:
-            logging.info(f"Shard {hf_dest} already uploaded, skipping.")
-            continue
-        with open(shard_path, "w", encoding="utf-8") as sf:
-            sf.writelines(shard_lines)
-        api.upload_file(
-            path_or_fileobj=shard_path,
-            path_in_repo=hf_dest,
-            repo_id=repo_id,
-            repo_type="dataset",
-            token=hf_token,
-        )
-        logging.info(f"Uploaded {hf_dest}")
-        os.remove(shard_path)
-        n += len(shard_lines)
-    logging.info(f"Pushed {n} new entries in shards to {repo_id}")
+    # Shard names are fixed by record offset, so re-uploading after a crash is idempotent
+    api.create_commit(
+        repo_id=HF_REPO_ID,
+        repo_type="dataset",
+        operations=operations,
+        commit_message=f"Add {len(operations)} shards",
+        token=HF_TOKEN,
+    )
+    for operation in operations:
+        logging.info(f"Uploaded {operation.path_in_repo}")
+    logging.info(f"Pushed {offset} new entries in shards to {HF_REPO_ID}")
+
+    # Carry the incomplete tail over to the next checkpoint before recording progress
+    next_start = shard_start + offset
+    next_path = checkpoint_path(next_start)
+    next_bytes = 0
+    if offset < table.num_rows:
+        write_checkpoint(next_path, table.slice(offset), "wb")
+        next_bytes = os.path.getsize(next_path)
+    save_state(STATE_PATH, {"skip": skip, "shard_start": next_start, "checkpoint_bytes": next_bytes})
+    os.remove(path)
+    return next_start
 
 def main():
     state = load_state(STATE_PATH)
     skip = state.get("skip", 0)
+    shard_start = state.get("shard_start", 0)
     total = 0
+    seen_digests = set()
 
-    while total < MAX_ENTRIES:
-        logging.info(f"Fetching documents with $skip={skip}, $top={BATCH_SIZE}")
-        for attempt in range(3):
-            try:
-                docs = fetch_documents(skip, BATCH_SIZE)
-                break
-            except Exception as e:
-                logging.warning(f"Fetch failed (try {attempt+1}/3): {e}")
-                time.sleep(3)
-        else:
+    api = HfApi() if HF_TOKEN else None
+    if api is None:
+        logging.warning("HF_TOKEN not provided, skipping upload; records stay in the local checkpoint.")
+    recover_checkpoint(checkpoint_path(shard_start), state.get("checkpoint_bytes"))
+    pending_rows, pending_bytes = checkpoint_stats(checkpoint_path(shard_start))
+
+    # Pages are only fetched in parallel when the total is known; otherwise page serially
+    count = count_documents()
+    workers = FETCH_WORKERS if count is not None else 1
+    end = skip + MAX_ENTRIES if count is None else min(skip + MAX_ENTRIES, count)
+
+    # Fetch, shard and upload in one pass: the checkpoint only holds the shard being filled
+    for docs in iter_pages(skip, end, workers):
+        if docs is None:
             logging.error("Fetch failed after retries. Aborting.")
             break
         if not docs:
             logging.info("No more documents to fetch.")
             break
-        emit_jsonl(docs, OUTPUT_PATH, SOURCE_LABEL)
+        path = checkpoint_path(shard_start)
+        rows, content_bytes = emit_records(docs, path, SOURCE_LABEL, seen_digests)
+        pending_rows += rows
+        pending_bytes += content_bytes
         total += len(docs)
         skip += len(docs)
-        save_state(STATE_PATH, {"skip": skip})
+        # Record how far the checkpoint reaches, so a page appended after this save can be dropped on resume
+        save_state(STATE_PATH, {"skip": skip, "shard_start": shard_start, "checkpoint_bytes": os.path.getsize(path)})
         logging.info(f"Fetched {len(docs)} docs, total={total}")
+        if api and (pending_rows >= SHARD_SIZE or pending_bytes >= SHARD_MAX_BYTES):
+            shard_start = push_shards(api, shard_start, skip, final=False)
+            pending_rows, pending_bytes = checkpoint_stats(checkpoint_path(shard_start))
         if len(docs) < BATCH_SIZE:
             logging.info("Reached last batch.")
             break
 
-    if HF_TOKEN:
-        push_to_hf(OUTPUT_PATH, HF_REPO_ID, HF_TOKEN)
-    else:
-        logging.warning("HF_TOKEN not provided, skipping upload.")
+    if api and pending_rows:
+        push_shards(api, shard_start, skip, final=True)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,18 @@
+import pypdfium2 as pdfium
+
+# PDF text extraction for the worker processes of batched_ingest's PDF pool. Kept apart from
+# the ingester, and importing nothing but pypdfium2, so the workers stay small.
+
+def extract_pdf_text(pdf_path: str) -> str:
+    """Extracts the text of every page of a PDF file using PDFium."""
+    pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        pages_text = []
+        for page in pdf:
+            textpage = page.get_textpage()
+            pages_text.append(textpage.get_text_range())
+            textpage.close()
+            page.close()
+        return "\n".join(pages_text)
+    finally:
+        pdf.close()